@@ -9,24 +9,27 @@ Checker script to crawl /projects/nlp-corpora/ directory.
 # builtins
 import argparse
 import code
+import collections
+import concurrent.futures
+import contextlib
+import dataclasses
 import datetime
-import glob
+import functools
+import hashlib
+import html
+import itertools
 import grp
 import json
+import math
 import os
-import platform
 import pwd
+import re
 import shutil
 import stat
-import subprocess
 import sys
-from typing import Any, List, Optional, Set, Tuple, Dict
+from typing import Any, IO, Iterator, List, NamedTuple, Optional, Set, FrozenSet, Tuple, Dict
 
 # 3rd party
-import humanfriendly
-import matplotlib
-matplotlib.use('Agg')  # set backed to avoid crash on non X-window server
-import matplotlib.pyplot as plt
 from mypy_extensions import TypedDict
 
 
@@ -34,22 +37,26 @@ from mypy_extensions import TypedDict
 # globals
 #
 
-class DirResult(TypedDict):
-    """information we want from all results"""
+@dataclasses.dataclass(slots=True)
+class DirResult:
+    """information we want from all results (slotted, as we make one per
+    corpus and read its fields a lot when building output)"""
     basename: str
-    description: Optional[str]
-    size_raw: int
-    size_human: Optional[str]
-    group_ok: bool
-    group: Optional[str]
-    owner_ok: bool
-    perms_ok: bool
-    dir_clean: bool
-    readme_exists: bool
-    readme_path: Optional[str]
-    readme_desc: bool
-    readme_proc_desc: bool
-    errors: List[str]
+    description: Optional[str] = None
+    size_raw: int = 0
+    size_human: Optional[str] = None
+    group_ok: bool = True
+    group: Optional[str] = None
+    owner_ok: bool = True
+    perms_ok: bool = True
+    dir_clean: bool = False
+    readme_exists: bool = False
+    readme_path: Optional[str] = None
+    readme_desc: bool = False
+    readme_proc_desc: bool = False
+    errors: List[str] = dataclasses.field(default_factory=list)
+    # whether all checks passed (compute_result_success(), stored once done)
+    success: bool = False
 
 
 class RestrictedGroup(TypedDict):
@@ -67,6 +74,21 @@ class Permissions(TypedDict):
     contents_dir: int
     contents_file: int
 
+class Problem(NamedTuple):
+    """A single failed group / owner / perms check. Kept unformatted (see
+    format_problem()) so the many of these we may find are cheap."""
+    # one of the PROBLEM_* kinds
+    kind: str
+    path: str
+    actual: Any
+    want: Any
+
+
+# kinds of Problems, worded for use in error messages
+PROBLEM_GROUP = 'group'
+PROBLEM_OWNER = 'owner'
+PROBLEM_PERMS = 'permission'
+
 # r--r--r--
 PERM_ALL_R = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
 
@@ -95,32 +117,58 @@ RESTRICTED_PERMS: Permissions = {
 
 # These are the things allowed to be in the top-level directory that aren't
 # checked for corpora, but should be empty.
-WHITELIST_DIRS = [
+WHITELIST_DIRS = frozenset({
     'nobackup',
     '_staging',
-]
+})
 
 # These are files we're ok with existing in the root of the repository.
-WHITELIST_FILES = [
+WHITELIST_FILES = frozenset({
     'README.md',
-]
+})
+
+# Everything in the top-level directory that isn't a corpus.
+TOP_WHITELIST = WHITELIST_DIRS | WHITELIST_FILES
 
 # These are the only things allowed in a top-level (corpus) directory.
-CLEAN_DIR_WHITELIST = [
+CLEAN_DIR_WHITELIST = frozenset({
     'original',
     'processed',
     'README.md',
-]
+})
+
+# uid this script runs as (to know whether we can chmod things).
+MY_UID = os.getuid()
 
 # amount above which we worry available space is running low
 TOTAL_SIZE_WORRY = 1400000000000  # ~= 1.4 TB
 
+# version of the --cache-dir file format. bump whenever DirResult (or what's
+# stored alongside it) changes, so files written by older versions are
+# ignored instead of misread.
+CACHE_VERSION = 3
+
 # files containing pre-written fixed markdown content we copy into the output
 # readme.
 HEADER_FN = 'header.md'
 MID_FN = 'mid.md'
 FOOTER_FN = 'footer.md'
 
+# decimal size units for format_size(), smallest first.
+SIZE_UNITS = ['KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB']
+
+# column widths of the summary table in the log
+LOG_COL_WIDTHS = (20, 20, 10, 6, 6, 6, 10, 8, 7, 7)
+
+# how booleans are shown in tables; index with the bool itself.
+FUN_BOOL = ('✗', '✓')
+
+# slice colors for plot_svg() (matplotlib's default color cycle)
+PLOT_COLORS = [
+    '#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
+    '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf',
+]
+
 BADGE_RESULT_FMT = '![](https://img.shields.io/badge/docs-{success}-{color}.svg?longCache=true&style=flat)'
 BADGE_DATE_FMT = '![](https://img.shields.io/badge/built-{date}-blue.svg?longCache=true&style=flat)'
 
@@ -128,82 +176,145 @@ BADGE_DATE_FMT = '![](https://img.shields.io/badge/built-{date}-blue.svg?longCac
 # functions
 #
 
-def read(path: str) -> str:
+def copy_into(path: str, dest: IO[str]) -> None:
+    """Copies the contents of the file at path into (open) file dest."""
     with open(path, 'r') as f:
-        return f.read()
+        shutil.copyfileobj(f, dest)
+
+
+def format_size(num_bytes: int) -> str:
+    """Returns human-readable size, e.g., "16.48 KB" (same format as
+    humanfriendly.format_size, which we used to import just for this)."""
+    for i in reversed(range(len(SIZE_UNITS))):
+        divider = 1000 ** (i + 1)
+        if num_bytes >= divider:
+            number = '{:.2f}'.format(num_bytes / divider).rstrip('0').rstrip('.')
+            return '{} {}'.format(number, SIZE_UNITS[i])
+    return '{} {}'.format(num_bytes, 'byte' if num_bytes == 1 else 'bytes')
 
 
 def build_top(success: bool) -> str:
     """Returns the markdown title and badges. Should go above header in output
     file."""
-    badge_result = BADGE_RESULT_FMT.format(
-        success=('passing' if success else 'errors'),
-        color=('brightgreen' if success else 'red'),
-    )
-    badge_date = BADGE_DATE_FMT.format(date='{:%-m/%-d/%y}'.format(datetime.datetime.now()))
-    return '\n'.join([
-        '# nlp-corpora',
-        '',
-        badge_result,
-        badge_date,
-        '',
-    ])
+    result, color = ('passing', 'brightgreen') if success else ('errors', 'red')
+    date = datetime.date.today().strftime('%-m/%-d/%y')
+    return f"# nlp-corpora\n\n{BADGE_RESULT_FMT.format(success=result, color=color)}\n{BADGE_DATE_FMT.format(date=date)}\n"
+
+
+def iter_tree(root: str, root_stat: os.stat_result) -> Iterator[Tuple[str, os.stat_result]]:
+    """Yields (path, stat result) for root (whose stat result is given) and,
+    if it's a directory, everything below it. Each path is stat'd once
+    without following symlinks, so the stat results can be used for both
+    sizes and checks.
+
+    Uses an explicit stack instead of recursion, but visits in the same
+    (top-down) order as os.walk would. Like os.walk, unreadable directories
+    are skipped. Like os.fwalk, each directory is listed through an open fd,
+    so entries are stat'd relative to it (fstatat) rather than by resolving
+    their full path again.
+    """
+    stack = [(root, root_stat)]
+    while stack:
+        dirpath, dir_stat = stack.pop()
+        yield dirpath, dir_stat
+        if not stat.S_ISDIR(dir_stat.st_mode):
+            continue
+        try:
+            dir_fd = os.open(dirpath, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError:
+            continue
+        subdirs = []
+        try:
+            with os.scandir(dir_fd) as it:
+                for entry in it:
+                    try:
+                        s = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    path = os.path.join(dirpath, entry.name)
+                    if stat.S_ISDIR(s.st_mode):
+                        subdirs.append((path, s))
+                    else:
+                        yield path, s
+        finally:
+            os.close(dir_fd)
+        stack.extend(reversed(subdirs))
 
 
 def get_size(path: str) -> int:
     """
-    Returns size in bytes.
+    Returns size in bytes of everything at and below path (like `du -bs`).
+
+    Only used for parts of a corpus that aren't otherwise walked;
+    walk_check() accumulates sizes as it goes so we don't stat twice.
     """
-    # Thanks to https://stackoverflow.com/a/25574638. Additional note: we
-    # switch based on platform because BSD doesn't support the -b option.
-    # (Better implementation would be to do in python.)
-    plat = platform.system()
-    if plat == 'Linux':
-        return int(subprocess.check_output(['du','-bs', path]).split()[0].decode('utf-8'))
-    elif plat == 'Darwin':
-        return 512 * int(subprocess.check_output(['du','-s', path]).split()[0].decode('utf-8'))
-    else:
-        raise ValueError('Unimplemented platform: "{}"'.format(plat))
+    return sum(s.st_size for _, s in iter_tree(path, os.lstat(path)))
 
 
 def get_dirs(base_dir: str) -> List[str]:
-    whitelist = WHITELIST_DIRS + WHITELIST_FILES
-    # get all subdirectories
-    globs = glob.glob(os.path.join(base_dir, '*'))
-    paths = []
-    for path in globs:
-        if os.path.basename(path) not in whitelist:
-            paths.append(path)
-    return sorted(paths)
+    # get all (non-hidden) subdirectories
+    with os.scandir(base_dir) as it:
+        return sorted(
+            e.path for e in it
+            if e.name not in TOP_WHITELIST and not e.name.startswith('.')
+        )
 
 
-def extract_group_config(path: str) -> Tuple[Set[str], Dict[str, RestrictedGroup]]:
-    """Returns (std_grps, restricted_grps)"""
-    config = json.loads(read(path))
-    return (set(config['standard']), config['restricted'])
+def extract_group_config(path: str) -> Tuple[FrozenSet[str], Dict[str, RestrictedGroup]]:
+    """Returns (std_grps, restricted_grps). std_grps is immutable, so it's
+    cheap and safe to hand to worker processes along with the rest of the
+    (plain, picklable) config."""
+    with open(path, 'r') as f:
+        config = json.load(f)
+    return (frozenset(config['standard']), dict(config['restricted']))
+
 
+# Name lookups can go through NSS (e.g., LDAP), and we do one per file, but
+# there are only a handful of distinct ids, so we cache them for the run.
+@functools.lru_cache(maxsize=None)
+def gid_to_name(gid: int) -> str:
+    return grp.getgrgid(gid).gr_name
 
-def get_grp(path: str) -> str:
-    return grp.getgrgid(os.stat(path).st_gid).gr_name
+
+@functools.lru_cache(maxsize=None)
+def uid_to_name(uid: int) -> str:
+    return pwd.getpwuid(uid).pw_name
+
+
+def format_problem(problem: Problem) -> str:
+    """Returns the error message for problem."""
+    if problem.kind == PROBLEM_GROUP:
+        return 'Expected "{}" to have group "{}", but had group "{}"'.format(
+            problem.path, problem.want, problem.actual,
+        )
+    elif problem.kind == PROBLEM_OWNER:
+        return 'Path "{}" has owner "{}", but needs to be one of "{}"'.format(
+            problem.path, problem.actual, problem.want,
+        )
+    else:
+        return 'Path "{}" has mode "{}", but want mode to be "{}"'.format(
+            problem.path, problem.actual, problem.want,
+        )
 
 
-def check_grp(path: str, want_grp: str) -> Tuple[bool, List[str]]:
-    """Returns whether it passed, and any errors."""
-    actual_grp = get_grp(path)
+def check_grp(path: str, want_grp: str, s: Optional[os.stat_result] = None) -> List[Problem]:
+    """Returns any problems (i.e., a group problem if it failed). `s` is the
+    (non-symlink-following) stat result for path, if the caller has it."""
+    if s is None:
+        s = os.lstat(path)
+    actual_grp = gid_to_name(s.st_gid)
     if want_grp != actual_grp:
-        return False, ['Expected "{}" to have group "{}", but had group "{}"'.format(
-            path, want_grp, actual_grp,
-        )]
-    return True, []
+        return [Problem(PROBLEM_GROUP, path, actual_grp, want_grp)]
+    return []
 
 
 def get_perms(
-        path: str,
-        std_grps: Set[str],
+        s: os.stat_result,
+        std_grps: FrozenSet[str],
         restrict_grps: Dict[str, RestrictedGroup],
     ) -> Tuple[Permissions, str, List[str]]:
     """Returns (permissions to use, group name, list of error messages)"""
-    grp_name = get_grp(path)
+    grp_name = gid_to_name(s.st_gid)
     if grp_name in std_grps:
         return STD_PERMS, grp_name, []
     elif grp_name in restrict_grps:
@@ -222,38 +333,34 @@ def check_op(
         ok_owners: Set[str],
         want_perms: int,
         change: bool = False,
-    ) -> Tuple[bool, bool, List[str]]:
-    """Check owner and permissions (and maybe change them)."""
-    owner_passed = True
-    perms_passed = True
-    errors: List[str] = []
-
-    s = os.stat(path)
+        s: Optional[os.stat_result] = None,
+    ) -> List[Problem]:
+    """Check owner and permissions (and maybe change them). `s` is the
+    (non-symlink-following) stat result for path, if the caller has it.
+    Returns any problems."""
+    if s is None:
+        s = os.lstat(path)
+    problems: List[Problem] = []
 
     # check owner
-    owner = pwd.getpwuid(s.st_uid).pw_name
+    owner = uid_to_name(s.st_uid)
     if owner not in ok_owners:
-        owner_passed = False
-        errors.append('Path "{}" has owner "{}", but needs to be one of "{}"'.format(
-            path, owner, ok_owners,
-        ))
+        problems.append(Problem(PROBLEM_OWNER, path, owner, ok_owners))
 
     # pre-check whether script could change permissions if asked to.
-    can_change = os.getuid() == s.st_uid
+    can_change = MY_UID == s.st_uid
 
-    # check permissions
+    # check permissions. symlinks don't have meaningful permissions of their
+    # own (and chmod would follow them), so skip them.
     cur_perms = stat.S_IMODE(s.st_mode)
-    if cur_perms != want_perms:
+    if cur_perms != want_perms and not stat.S_ISLNK(s.st_mode):
         # failed; maybe change
         if change and can_change:
             os.chmod(path, want_perms)
         else:
-            perms_passed = False
-            errors.append('Path "{}" has mode "{}", but want mode to be "{}"'.format(
-                path, cur_perms, want_perms,
-            ))
+            problems.append(Problem(PROBLEM_PERMS, path, cur_perms, want_perms))
 
-    return (owner_passed, perms_passed, errors)
+    return problems
 
 
 def check_gop(
@@ -264,26 +371,28 @@ def check_gop(
         want_perms: int,
         change: bool = False,
         extend_errors: bool = True,
-    ) -> Tuple[bool, bool, bool]:
+        s: Optional[os.stat_result] = None,
+    ) -> List[Problem]:
     """Wrapper to help in checking group, owner, and perms, and merge results
-    into current results.
+    into current results. Returns the problems found.
 
     extend_errors --- provided to avoid GB of logs when all files are wrong LOL
+    s --- (non-symlink-following) stat result for path, if the caller has one
+        already (so each path is only stat'd once); otherwise stat'd here
     """
-    # grp
-    grp_ok, grp_errors = check_grp(path, want_grp)
-    res['group_ok'] = res['group_ok'] and grp_ok
-    if extend_errors:
-        res['errors'].extend(grp_errors)
-
-    # owner + perms
-    owner_ok, perms_ok, op_errors = check_op(path, ok_owners, want_perms, change)
-    res['owner_ok'] = res['owner_ok'] and owner_ok
-    res['perms_ok'] = res['perms_ok'] and perms_ok
+    if s is None:
+        s = os.lstat(path)
+    problems = check_grp(path, want_grp, s) + check_op(path, ok_owners, want_perms, change, s)
+    for problem in problems:
+        if problem.kind == PROBLEM_GROUP:
+            res.group_ok = False
+        elif problem.kind == PROBLEM_OWNER:
+            res.owner_ok = False
+        else:
+            res.perms_ok = False
     if extend_errors:
-        res['errors'].extend(op_errors)
-
-    return grp_ok, owner_ok, perms_ok
+        res.errors.extend(format_problem(p) for p in problems)
+    return problems
 
 
 def walk_check(
@@ -295,36 +404,177 @@ def walk_check(
         want_file_perms: int,
         change: bool = False,
         verbose: bool = False,
+        early_exit: bool = True,
+        skip_size: bool = False,
     ) -> None:
     """Checks group / owner / perms recursively under a directory (e.g.,
-    'original/' or 'processed/')."""
-    g, o, p = True, True, True
-    for dirpath, dirnames, filenames in os.walk(root):
-        rg, ro, rp = check_gop(res, dirpath, want_grp, ok_owners, want_dir_perms, change, verbose)
-        g, o, p = g and rg, o and ro, p and rp
-        for filename in filenames:
-            rg, ro, rp = check_gop(res, os.path.join(dirpath, filename), want_grp, ok_owners, want_file_perms, change, verbose)
-            g, o, p = g and rg, o and ro, p and rp
-
-    # if not verbose, we didn't add individual error messages, so add some now
+    'original/' or 'processed/'). Also adds the size of everything under it to
+    res.size_raw, so that each path is only stat'd once.
+
+    early_exit --- stop checking once group, owner, and perms have all failed
+        (the rest is only walked for its size). Never applies when verbose or
+        changing perms, as then we need to visit everything.
+    skip_size --- sizes aren't wanted, so once checking stops, the rest of
+        the tree isn't walked at all.
+    """
+    try:
+        root_stat = os.lstat(root)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISDIR(root_stat.st_mode):
+        # nothing to walk (e.g., a symlink, which we don't follow), but the
+        # path itself still needs the right group and owner.
+        res.size_raw += root_stat.st_size
+        check_gop(res, root, want_grp, ok_owners, want_file_perms, change, s=root_stat)
+        return
+
+    # tally problems by kind (keeping the first of each as an example), so
+    # that when not verbose we can summarize them without keeping them all.
+    counts: Dict[str, int] = collections.Counter()
+    examples: Dict[str, Problem] = {}
+    stop_early = early_exit and not verbose and not change
+    checking = True
+    # this loop runs once per file, so keep it lean: sum the size locally
+    # and only look at problems when there are some.
+    size = 0
+    is_dir = stat.S_ISDIR
+    for path, s in iter_tree(root, root_stat):
+        if not checking and skip_size:
+            break
+        size += s.st_size
+        if not checking:
+            continue
+        want_perms = want_dir_perms if is_dir(s.st_mode) else want_file_perms
+        problems = check_gop(res, path, want_grp, ok_owners, want_perms, change, verbose, s)
+        if problems:
+            for problem in problems:
+                counts[problem.kind] += 1
+                examples.setdefault(problem.kind, problem)
+            checking = not stop_early or len(counts) < 3
+    res.size_raw += size
+
+    # if not verbose, we didn't add individual error messages, so add a summary
+    # of each kind now. if we stopped checking early, counts are only lower
+    # bounds, so say so.
     if not verbose:
-        base_msg = 'One or more file/dirs at/below "{}" has {} errors.'
-        if not g:
-            res['errors'].append(base_msg.format(root, 'group'))
-        if not o:
-            res['errors'].append(base_msg.format(root, 'owner'))
-        if not p:
-            res['errors'].append(base_msg.format(root, 'permission'))
+        base_msg = 'One or more file/dirs at/below "{}" has {} errors ({}{} found). First: {}'
+        at_least = '' if checking else 'at least '
+        for kind in (PROBLEM_GROUP, PROBLEM_OWNER, PROBLEM_PERMS):
+            if counts[kind] > 0:
+                res.errors.append(base_msg.format(
+                    root, kind, at_least, counts[kind], format_problem(examples[kind]),
+                ))
+
 
+def links_to_file_inside(link: str, root: str) -> bool:
+    """Returns whether symlink `link` (eventually) points to a regular file
+    that's inside directory `root`."""
+    target = os.path.realpath(link)
+    real_root = os.path.realpath(root)
+    return os.path.isfile(target) and os.path.commonpath([target, real_root]) == real_root
+
+
+def find_mentioned(names: List[str], text: str) -> Set[str]:
+    """Returns which of names appear (as substrings) in text, using one regex
+    scan rather than one substring search per name."""
+    if len(names) == 0:
+        return set()
+    # Longest names first, looked for at every position. If a name appears at
+    # some position, the match there is either it or a longer name it's a
+    # prefix of, so checking found matches catches everything.
+    alternation = '|'.join(re.escape(n) for n in sorted(names, key=len, reverse=True))
+    found = {m.group(1) for m in re.finditer('(?=({}))'.format(alternation), text)}
+    return {n for n in names if n in found or any(n in f for f in found)}
+
+
+def cache_path(
+        cache_dir: str,
+        path: str,
+        std_grps: FrozenSet[str],
+        restricted_grps: Dict[str, RestrictedGroup],
+        ok_owners: Set[str],
+        verbose: bool,
+        skip_size: bool,
+    ) -> str:
+    """Returns where to cache the result for corpus path. The name depends on
+    everything that affects the result, so changing e.g. the group config
+    won't reuse old results.
+
+    Paths in the result (e.g., readme_path, and those in errors) are built
+    from path exactly as given, so a relative path is only reused from the
+    same working directory: both it and its absolute form are in the key.
+    """
+    key = json.dumps([
+        os.path.abspath(path),
+        path,
+        sorted(std_grps),
+        restricted_grps,
+        sorted(ok_owners),
+        verbose,
+        skip_size,
+    ], sort_keys=True)
+    return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def cache_stamp(path: str) -> List[Optional[int]]:
+    """Returns ctimes (ns) of corpus path and its README.md (None if
+    missing). A cached result is only reused if these haven't changed. ctime
+    rather than mtime, as it also changes on chmod / chown.
+
+    Note this can be stale: changes deeper in the corpus (e.g., to files in
+    original/, or their perms) don't change either ctime.
+    """
+    stamp: List[Optional[int]] = []
+    for p in (path, os.path.join(path, 'README.md')):
+        try:
+            stamp.append(os.lstat(p).st_ctime_ns)
+        except OSError:
+            stamp.append(None)
+    return stamp
+
+
+def read_cached_result(cache_fn: str, stamp: List[Optional[int]]) -> Optional[DirResult]:
+    """Returns the cached result at cache_fn, if there is one for stamp.
+    Anything unreadable, stale, or from another cache format is a miss."""
+    try:
+        with open(cache_fn, 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get('version') != CACHE_VERSION:
+        return None
+    if cached.get('stamp') != stamp:
+        return None
+    # every field must be present, so none silently falls back to its default
+    result = cached.get('result')
+    fields = {f.name for f in dataclasses.fields(DirResult)}
+    if not isinstance(result, dict) or set(result) != fields:
+        return None
+    return DirResult(**result)
+
+
+def write_cached_result(cache_fn: str, stamp: List[Optional[int]], res: DirResult) -> None:
+    os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+    # write then rename so a concurrent reader never sees a partial file
+    tmp_fn = '{}.{}.tmp'.format(cache_fn, os.getpid())
+    with open(tmp_fn, 'w') as f:
+        json.dump({
+            'version': CACHE_VERSION,
+            'stamp': stamp,
+            'result': dataclasses.asdict(res),
+        }, f)
+    os.replace(tmp_fn, cache_fn)
 
 
 def check_dir(
         path: str,
-        std_grps: Set[str],
+        std_grps: FrozenSet[str],
         restricted_grps: Dict[str, RestrictedGroup],
         ok_owners: Set[str],
         fix_perms: bool = False,
         verbose: bool = False,
+        cache_dir: Optional[str] = None,
+        skip_size: bool = False,
     ) -> DirResult:
     """
     For a corpus directory (`path`), checks its properties to ensure they
@@ -333,68 +583,140 @@ def check_dir(
     Calling this `path` and not `directory` or something because it may
     actually end up being a file and not a directory, and we need to handle
     that case. Also, it's a full path, not just a local directory.
+
+    If cache_dir is provided, the result is saved there, and a saved result
+    is returned instead of checking if the corpus looks unchanged (see
+    cache_stamp()). Saved results aren't used when fixing perms.
+
+    If skip_size is True, parts of the corpus that aren't checked aren't
+    walked just to size them, and the size is reported as '-'.
     """
+    if cache_dir is not None:
+        cache_fn = cache_path(cache_dir, path, std_grps, restricted_grps, ok_owners, verbose, skip_size)
+        stamp = cache_stamp(path)
+        if not fix_perms:
+            cached = read_cached_result(cache_fn, stamp)
+            if cached is not None:
+                return cached
+
     # define res upfront and mutate as we discover things
-    res: DirResult = {
-        'basename': os.path.basename(path),
-        'description': None,
-        'size_raw': 0,
-        'size_human': None,
-        'group_ok': True,
-        'group': None,
-        'owner_ok': True,
-        'perms_ok': True,
-        'dir_clean': False,
-        'readme_exists': False,
-        'readme_path': None,
-        'readme_desc': False,
-        'readme_proc_desc': False,
-        'errors': [],
-    }
-
-    size_bytes = get_size(path)
-    res['size_raw'] = size_bytes
-    res['size_human'] = humanfriendly.format_size(size_bytes)
+    res = DirResult(basename=os.path.basename(path))
+
+    # size is accumulated into res.size_raw while checking, so we only
+    # format it once everything has been visited.
+    check_corpus(res, path, std_grps, restricted_grps, ok_owners, fix_perms, verbose, skip_size)
+    if skip_size:
+        # whatever was summed while checking is only part of the total
+        res.size_raw = 0
+        res.size_human = '-'
+    else:
+        res.size_human = format_size(res.size_raw)
+    res.success = compute_result_success(res)
+    if cache_dir is not None:
+        write_cached_result(cache_fn, stamp, res)
+    return res
+
+
+def check_corpus(
+        res: DirResult,
+        path: str,
+        std_grps: FrozenSet[str],
+        restricted_grps: Dict[str, RestrictedGroup],
+        ok_owners: Set[str],
+        fix_perms: bool = False,
+        verbose: bool = False,
+        skip_size: bool = False,
+    ) -> None:
+    """Does the actual checks for check_dir(), mutating res. Returns early
+    once a failed check means the rest can't be checked sensibly.
+
+    Every path under the corpus has its size added to res.size_raw
+    exactly once: either while it's being checked, or with get_size() if
+    we're not going to check it (unless skip_size).
+    """
+    top_stat = os.lstat(path)
 
     # edge case: if it's a file instead of a directory, everything else should
     # be marked as invalid and should just return now.
-    if not os.path.isdir(path):
-        res['errors'].append('Not a directory but in top-level.')
-        return res
+    if not stat.S_ISDIR(top_stat.st_mode):
+        res.size_raw = top_stat.st_size
+        res.errors.append('Not a directory but in top-level.')
+        return
 
     # get set of permissions. if the group isn't known, we don't know the right
     # permissions to use and we probably don't want everything below it to have
     # the same (wrong) group, so we stop early.
-    perms, grp_name, grp_errors = get_perms(path, std_grps, restricted_grps)
+    perms, grp_name, grp_errors = get_perms(top_stat, std_grps, restricted_grps)
     if len(grp_errors) > 0:
-        res['group_ok'] = False
-        res['errors'].extend(grp_errors)
-        return res
-    res['group'] = grp_name
+        if not skip_size:
+            res.size_raw = get_size(path)
+        res.group_ok = False
+        res.errors.extend(grp_errors)
+        return
+    res.group = grp_name
 
     # check group + owner + perms of directory itself
-    check_gop(res, path, grp_name, ok_owners, perms['top'], fix_perms)
+    res.size_raw += top_stat.st_size
+    check_gop(res, path, grp_name, ok_owners, perms['top'], fix_perms, s=top_stat)
 
     # The rest of the options don't depend on whether the directory is clean,
-    # so we just check that first.
-    res['dir_clean'] = True
-    for inner in glob.glob(os.path.join(path, '*')):
-        inner_basename = os.path.basename(inner)
-        if inner_basename not in CLEAN_DIR_WHITELIST:
-            res['dir_clean'] = False
-            res['errors'].append('Directory not clean: bad entry: "{}".'.format(inner_basename))
-
-    # Check whether readme even exists. If it doesn't it can't be complete and
-    # can't have a description, so we just stop checking now and return.
+    # so we just check that first. original/ and processed/ are sized when
+    # they're walked below; everything else is sized here.
+    res.dir_clean = True
+    n_bad = 0
+    readme_stat = None
+    processed_is_dir = False
+    unwalked = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name in ('original', 'processed'):
+                unwalked.append(entry.path)
+                if entry.name == 'processed':
+                    processed_is_dir = entry.is_dir(follow_symlinks=False)
+                continue
+            s = entry.stat(follow_symlinks=False)
+            if stat.S_ISDIR(s.st_mode):
+                if not skip_size:
+                    res.size_raw += get_size(entry.path)
+            else:
+                res.size_raw += s.st_size
+            if entry.name == 'README.md':
+                readme_stat = s
+            # (hidden entries are not considered, same as a shell glob.) if not
+            # verbose, only the first bad entry is named; the rest are counted.
+            if entry.name not in CLEAN_DIR_WHITELIST and not entry.name.startswith('.'):
+                res.dir_clean = False
+                n_bad += 1
+                if verbose or n_bad == 1:
+                    res.errors.append('Directory not clean: bad entry: "{}".'.format(entry.name))
+    if not verbose and n_bad > 1:
+        res.errors.append('Directory not clean: {} more bad entries.'.format(n_bad - 1))
+
+    # Check whether readme even exists (as a regular file, or a symlink to one
+    # inside the corpus). If it doesn't it can't be complete and can't have a
+    # description, so we just stop checking now and return.
     readme_fn = os.path.join(path, 'README.md')
-    if not os.path.isfile(readme_fn):
-        res['errors'].append('Missing README.md')
-        return res
-    res['readme_exists'] = True
-    res['readme_path'] = readme_fn
+    readme_ok = readme_stat is not None and (
+        stat.S_ISREG(readme_stat.st_mode) or
+        (stat.S_ISLNK(readme_stat.st_mode) and links_to_file_inside(readme_fn, path))
+    )
+    if not readme_ok:
+        if not skip_size:
+            for inner in unwalked:
+                res.size_raw += get_size(inner)
+        if readme_stat is None:
+            res.errors.append('Missing README.md')
+        elif stat.S_ISLNK(readme_stat.st_mode):
+            res.errors.append('README.md is a symlink, but not to a file inside the corpus')
+        else:
+            res.errors.append('README.md is not a regular file')
+        return
+    res.readme_exists = True
+    res.readme_path = readme_fn
 
-    # check readme group, owner, perms
-    check_gop(res, readme_fn, grp_name, ok_owners, perms['readme'], fix_perms)
+    # check readme group, owner, perms (of the link itself, if it's a symlink;
+    # its target is checked along with the rest of the corpus)
+    check_gop(res, readme_fn, grp_name, ok_owners, perms['readme'], fix_perms, s=readme_stat)
 
     # README.md format:
     #
@@ -405,85 +727,71 @@ def check_dir(
     # <rest of contents>
     # ```
 
-    # Read in entire readme.
+    # Description is second non-empty line in readme (first is title). If
+    # there's a processed/ dir, the check for it below needs the whole readme,
+    # so read it all once here. Otherwise, only read as far as we need to.
+    readme = ''
     with open(readme_fn, 'r') as f:
-        readme = [line.strip() for line in f.readlines()]
-
-    # Description is second non-empty line in readme (first is title).
-    for line in readme[1:]:
-        if len(line) > 0:
-            res['description'] = line
-            break
+        lines: Iterator[str] = f
+        if processed_is_dir:
+            readme = f.read()
+            lines = iter(readme.split('\n'))
+        next(lines, None)
+        for line in lines:
+            line = line.strip()
+            if len(line) > 0:
+                res.description = line
+                break
 
     # Must have something in desc to pass desc-having check.
-    res['readme_desc'] = res['description'] is not None
-    if not res['readme_desc']:
-        res['errors'].append('Missing description (second non-empty line) in README.md')
-
-    # Check original/ directory recursively for group/owner/perms.
-    walk_check(
-        res,
-        os.path.join(path, 'original'),
-        grp_name,
-        ok_owners,
-        perms['contents_dir'],
-        perms['contents_file'],
-        fix_perms,
-        verbose,
-    )
+    res.readme_desc = res.description is not None
+    if not res.readme_desc:
+        res.errors.append('Missing description (second non-empty line) in README.md')
+
+    # Check original/ directory recursively for group/owner/perms. (If it
+    # isn't a directory, e.g. a symlink, only the path itself is checked.)
+    walk_args = (grp_name, ok_owners, perms['contents_dir'], perms['contents_file'], fix_perms, verbose)
+    walk_check(res, os.path.join(path, 'original'), *walk_args, skip_size=skip_size)
 
     # Pre-check: if no "processed" directories exist, the README doesn't need
     # to talk about them.
-    res['readme_proc_desc'] = True
     processed_dir = os.path.join(path, 'processed')
-    if not os.path.isdir(processed_dir):
-        return res
+    res.readme_proc_desc = True
+    if not processed_is_dir:
+        if processed_dir in unwalked:
+            walk_check(res, processed_dir, *walk_args, skip_size=skip_size)
+        return
 
     # Processed directories exist. Make sure the readme talks about all of
     # them.
-    full_readme = ' '.join(readme)
-    for p_subdir in glob.glob(os.path.join(processed_dir, '*')):
-        p_subdir_basename = os.path.basename(p_subdir)
-        if p_subdir_basename not in full_readme:
-            res['readme_proc_desc'] = False
-            res['errors'].append('Missing description in README.md for processed variant: "{}"'.format(
-                p_subdir_basename
+    with os.scandir(processed_dir) as it:
+        p_subdirs = [e.name for e in it if not e.name.startswith('.')]
+    mentioned = find_mentioned(p_subdirs, readme)
+    for p_subdir in p_subdirs:
+        if p_subdir not in mentioned:
+            res.readme_proc_desc = False
+            res.errors.append('Missing description in README.md for processed variant: "{}"'.format(
+                p_subdir
             ))
 
     # Check processed/ directory recursively for group/owner/perms.
-    walk_check(
-        res,
-        processed_dir,
-        grp_name,
-        ok_owners,
-        perms['contents_dir'],
-        perms['contents_file'],
-        fix_perms,
-        verbose,
-    )
-
-    return res
+    walk_check(res, processed_dir, *walk_args, skip_size=skip_size)
 
 
-def fun_bool(boring: bool) -> str:
-    return '✓' if boring else '✗'
+def results_row(res: DirResult, std_grps: FrozenSet[str]) -> str:
+    """Row of the README.md status table for one corpus."""
+    name = res.basename
+    access = FUN_BOOL[True] if res.group in std_grps else f"[`{res.group}`](#restricted-access)"
+    return f"[{name}](doc/{name}) | {res.description} | {res.size_human} | {access} | {FUN_BOOL[res.success]}"
 
 
-def generate_results_markdown(results: List[DirResult], std_grps: Set[str]) -> str:
+def generate_results_markdown(results: List[DirResult], std_grps: FrozenSet[str]) -> str:
     """Generates table for README.md giving corpora status overview."""
     fmt = '{} | {} | {} | {} | {}'
     header = fmt.format('Corpus', 'Description', 'Size', '[Access](#restricted-access)', 'Status')
     separator = fmt.format(*(['---']*5))
-    rows = []
-    for res in results:
-        rows.append(fmt.format(
-            '[{}]({})'.format(res['basename'], os.path.join('doc/', res['basename'])),
-            res['description'],
-            res['size_human'],
-            fun_bool(True) if res['group'] in std_grps else '[`{}`](#restricted-access)'.format(res['group']),
-            fun_bool(compute_result_success(res)),
-        ))
-    return '\n'.join([header, separator] + rows)
+    rows = (results_row(res, std_grps) for res in results)
+    return '\n'.join(itertools.chain((header, separator), rows))
 
 
 def generate_access_markdown(restricted_grps: Dict[str, RestrictedGroup]) -> str:
@@ -502,54 +810,148 @@ def generate_access_markdown(restricted_grps: Dict[str, RestrictedGroup]) -> str
 
 def compute_result_success(r: DirResult) -> bool:
     return (
-        r['group_ok'] and r['owner_ok'] and r['perms_ok'] and
-        r['dir_clean'] and r['readme_exists'] and r['readme_desc'] and
-        r['readme_proc_desc']
+        r.group_ok and r.owner_ok and r.perms_ok and
+        r.dir_clean and r.readme_exists and r.readme_desc and
+        r.readme_proc_desc
     )
 
 
 def compute_success(results: List[DirResult]) -> bool:
     """Returns whether we had 100% passing checks."""
-    for r in results:
-        if not compute_result_success(r):
-            return False
-    return True
+    return all(r.success for r in results)
 
 
-def build_doc_dir(results: List[DirResult], doc_dir: str) -> None:
-    # clean doc dir to remove anything that exists, then create it fresh
-    if os.path.exists(doc_dir):
-        if os.path.isdir(doc_dir):
-            shutil.rmtree(doc_dir)
-        else:
-            os.remove(doc_dir)
-    os.makedirs(doc_dir)
-
-    for res in results:
-        # make the dir
-        corpus_dir = os.path.join(doc_dir, res['basename'])
-        os.makedirs(corpus_dir)
-
-        # either copy real readme, or write a tmp dummy one
-        readme_fn = os.path.join(corpus_dir, 'README.md')
-        if res['readme_exists'] and res['readme_path'] is not None:
-            shutil.copy(res['readme_path'], readme_fn)
-        else:
-            with open(readme_fn, 'w') as f:
-                f.write('# {}\n\n(readme is missing! add one soon!)\n'.format(
-                    res['basename'],
-                ))
+def remove_path(path: str) -> None:
+    """Removes path (recursively, if it's a directory) if it exists."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
 
 
-def plot(results: List[DirResult], plot_dest: str) -> None:
-    """Writes donut plot of disk usages to plot_dest."""
-    total_size = sum([r['size_raw'] for r in results])
-    group_sizes = [r['size_raw']/total_size for r in results]
+def link_or_copy(src: str, dst: str) -> None:
+    """Hardlinks src to dst, which moves no data. Falls back to copying if
+    they're on different filesystems (or linking isn't allowed). If src is a
+    symlink, what it points to is linked, not the (maybe relative) link."""
+    src = os.path.realpath(src)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def build_doc_dir(results: List[DirResult], doc_dir: str) -> None:
+    # build the doc dir fresh in a staging dir next to it, then swap it in
+    # place of anything that exists, so it's never left half-built. (Hardlinked
+    # readmes are fine: the whole dir is rebuilt each run.)
+    staging_dir = doc_dir.rstrip(os.sep) + '.staging'
+    remove_path(staging_dir)
+    os.makedirs(staging_dir)
+    try:
+        for res in results:
+            # make the dir
+            corpus_dir = os.path.join(staging_dir, res.basename)
+            os.makedirs(corpus_dir)
+
+            # either link real readme, or write a tmp dummy one
+            readme_fn = os.path.join(corpus_dir, 'README.md')
+            if res.readme_exists and res.readme_path is not None:
+                link_or_copy(res.readme_path, readme_fn)
+            else:
+                with open(readme_fn, 'w') as f:
+                    f.write('# {}\n\n(readme is missing! add one soon!)\n'.format(
+                        res.basename,
+                    ))
+    except BaseException:
+        # don't leave the staging dir behind, as it sits next to doc_dir in
+        # the output repo and would get committed along with it.
+        remove_path(staging_dir)
+        raise
+
+    remove_path(doc_dir)
+    os.replace(staging_dir, doc_dir)
+
+
+def plot_slices(results: List[DirResult]) -> Tuple[List[float], List[str]]:
+    """Returns (fraction of total size, label) for each result's slice of the
+    donut plot. Labels are blank for slices too small to fit one."""
+    total_size = sum([r.size_raw for r in results])
+    group_sizes = [r.size_raw/total_size for r in results]
     group_names = [
-        '{}\n({})'.format(r['basename'], r['size_human'])
-        if r['size_raw']/total_size > .03 else ''
+        '{}\n({})'.format(r.basename, r.size_human)
+        if r.size_raw/total_size > .03 else ''
         for r in results
     ]
+    return group_sizes, group_names
+
+
+def plot_svg(results: List[DirResult], plot_dest: str) -> None:
+    """Writes donut plot of disk usages to plot_dest as an SVG. Drawn by hand
+    so we don't need matplotlib; mimics the matplotlib version's defaults
+    (slices counterclockwise from 3 o'clock, labels just outside)."""
+    group_sizes, group_names = plot_slices(results)
+    width, height = 640, 480
+    cx, cy = width / 2, height / 2
+    outer_r, inner_r = 150, 150 * (0.1 / 0.8)  # radius=0.8, width=0.7
+
+    def point(r: float, angle: float) -> str:
+        # y is flipped as svg's y axis points down
+        return '{:.2f},{:.2f}'.format(cx + r * math.cos(angle), cy - r * math.sin(angle))
+
+    lines = [
+        '<svg xmlns="http://www.w3.org/2000/svg" width="{w}" height="{h}" viewBox="0 0 {w} {h}">'.format(w=width, h=height),
+        '<rect width="100%" height="100%" fill="white"/>',
+    ]
+    start = 0.0
+    for i, (frac, name) in enumerate(zip(group_sizes, group_names)):
+        if frac <= 0:
+            continue
+        end = start + frac * 2 * math.pi
+        # each arc is drawn in two halves so that no arc is more than half a
+        # circle (which also makes a 100% slice work).
+        mid = (start + end) / 2
+        d = 'M {} A {r} {r} 0 0 0 {} A {r} {r} 0 0 0 {} '.format(
+            point(outer_r, start), point(outer_r, mid), point(outer_r, end), r=outer_r,
+        ) + 'L {} A {r} {r} 0 0 1 {} A {r} {r} 0 0 1 {} Z'.format(
+            point(inner_r, end), point(inner_r, mid), point(inner_r, start), r=inner_r,
+        )
+        lines.append('<path d="{}" fill="{}" stroke="white"/>'.format(
+            d, PLOT_COLORS[i % len(PLOT_COLORS)],
+        ))
+        if name != '':
+            x = cx + 1.1 * outer_r * math.cos(mid)
+            y = cy - 1.1 * outer_r * math.sin(mid)
+            anchor = 'start' if math.cos(mid) >= 0 else 'end'
+            text_lines = name.split('\n')
+            # center the block of lines vertically on the label point
+            first_dy = 0.35 - 0.6 * (len(text_lines) - 1)
+            spans = ''.join(
+                '<tspan x="{:.2f}" dy="{:.2f}em">{}</tspan>'.format(
+                    x, first_dy if j == 0 else 1.2, html.escape(t),
+                )
+                for j, t in enumerate(text_lines)
+            )
+            lines.append(
+                '<text x="{:.2f}" y="{:.2f}" text-anchor="{}" font-family="sans-serif" font-size="10">{}</text>'.format(
+                    x, y, anchor, spans,
+                )
+            )
+        start = end
+    lines.append('</svg>')
+
+    with open(plot_dest, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def plot_matplotlib(results: List[DirResult], plot_dest: str) -> None:
+    """Writes donut plot of disk usages to plot_dest, in whatever format
+    matplotlib infers from its extension."""
+    # matplotlib is slow to import and only needed here, so import it lazily.
+    import matplotlib
+    matplotlib.use('Agg')  # set backed to avoid crash on non X-window server
+    import matplotlib.pyplot as plt
+
+    group_sizes, group_names = plot_slices(results)
 
     # Create colors
     #a, b, c=[plt.cm.Blues, plt.cm.Reds, plt.cm.Greens]
@@ -564,76 +966,120 @@ def plot(results: List[DirResult], plot_dest: str) -> None:
     plt.savefig(plot_dest)
 
 
-def generate_log(base_dir: str, success: bool, results: List[DirResult]) -> str:
-    """Takes results and generates log file for more detailed results."""
+def log_table_row(cols: Tuple[Any, ...]) -> str:
+    """Formats one row of the log's summary table: each column is cut to one
+    less than its width in LOG_COL_WIDTHS, then padded to it."""
+    return ' '.join(str(c)[:w - 1].ljust(w) for c, w in zip(cols, LOG_COL_WIDTHS))
+
+
+def log_row(res: DirResult) -> str:
+    """Row of the log's summary table for one corpus (columns as in
+    generate_log's header)."""
+    return log_table_row((
+        res.basename,
+        res.description,
+        res.size_human,
+        FUN_BOOL[res.group_ok],
+        FUN_BOOL[res.owner_ok],
+        FUN_BOOL[res.perms_ok],
+        FUN_BOOL[res.dir_clean],
+        FUN_BOOL[res.readme_exists],
+        FUN_BOOL[res.readme_desc],
+        FUN_BOOL[res.readme_proc_desc],
+    ))
+
+
+def generate_log(base_dir: str, success: bool, results: List[DirResult]) -> Iterator[str]:
+    """Takes results and generates log file for more detailed results. Yields
+    the log line by line so it can be written out as it's built."""
     # overall
-    buffer = ['Overall pass: {}'.format(success), '']
+    yield 'Overall pass: {}'.format(success)
+    yield ''
 
     # summary table
-    fmt = '{!s:20.19} {!s:20.19} {!s:10.9} {!s:6.5} {!s:6.5} {!s:6.5} {!s:10.9} {!s:8.7} {!s:7.6} {!s:7.6}'
     header = ('dirname', 'desc', 'size', 'group', 'owner', 'perms', 'dir clean', 'README?', 'R-desc', 'R-proc')
-    buffer.append(fmt.format(*header))
-    buffer.append(fmt.format(*(['---'] * 10)))
-    for res in results:
-        buffer.append(fmt.format(
-            res['basename'],
-            res['description'],
-            res['size_human'],
-            fun_bool(res['group_ok']),
-            fun_bool(res['owner_ok']),
-            fun_bool(res['perms_ok']),
-            fun_bool(res['dir_clean']),
-            fun_bool(res['readme_exists']),
-            fun_bool(res['readme_desc']),
-            fun_bool(res['readme_proc_desc']),
-        ))
-    buffer.append('')
+    yield log_table_row(header)
+    yield log_table_row(('---',) * len(header))
+    yield from (log_row(res) for res in results)
+    yield ''
 
     # detailed errors per result
     if not success:
-        buffer.append('Detailed errors:')
+        yield 'Detailed errors:'
         for res in results:
-            if len(res['errors']) > 0:
-                buffer.append(res['basename'])
-                buffer.append('-'*80)
-                for e in res['errors']:
-                    buffer.append(' - {}'.format(e))
-                buffer.append('')
+            if len(res.errors) > 0:
+                yield res.basename
+                yield '-'*80
+                for e in res.errors:
+                    yield ' - {}'.format(e)
+                yield ''
 
     # total size check
-    total_used = sum([r['size_raw'] for r in results])
+    total_used = sum([r.size_raw for r in results])
     if total_used >= TOTAL_SIZE_WORRY:
-        buffer.append('Total bytes used ({}) above worry limit ({})'.format(
-            humanfriendly.format_size(total_used),
-            humanfriendly.format_size(TOTAL_SIZE_WORRY),
-        ))
-        buffer.append('May need to look into expanding disk size soon!')
+        yield 'Total bytes used ({}) above worry limit ({})'.format(
+            format_size(total_used),
+            format_size(TOTAL_SIZE_WORRY),
+        )
+        yield 'May need to look into expanding disk size soon!'
 
     # whitelist dirs empty check
-    for b in WHITELIST_DIRS:
+    for b in sorted(WHITELIST_DIRS):
         d = os.path.join(base_dir, b)
-        n_contents = len(os.listdir(d)) if os.path.isdir(d) else 0
+        n_contents = 0
+        if os.path.isdir(d):
+            with os.scandir(d) as it:
+                n_contents = sum(1 for _ in it)
         if n_contents > 0:
-            buffer.append('Wanted directory "{}" to be empty, but contained {} files.'.format(
+            yield 'Wanted directory "{}" to be empty, but contained {} files.'.format(
                 d, n_contents,
-            ))
+            )
 
-    return '\n'.join(buffer)
+
+def write_readme(
+        f: IO[str],
+        success: bool,
+        results: List[DirResult],
+        std_grps: FrozenSet[str],
+        restricted_grps: Dict[str, RestrictedGroup],
+    ) -> None:
+    """Writes the output markdown file to f. The fixed markdown files are
+    copied straight in rather than read into memory."""
+    f.write(build_top(success) + '\n')
+    copy_into(HEADER_FN, f)
+    f.write('\n' + generate_results_markdown(results, std_grps) + '\n')
+    copy_into(MID_FN, f)
+    f.write('\n' + generate_access_markdown(restricted_grps) + '\n')
+    copy_into(FOOTER_FN, f)
 
 
 def check(
         base_dir: str,
-        std_grps: Set[str],
+        std_grps: FrozenSet[str],
         restricted_grps: Dict[str, RestrictedGroup],
         ok_owners: Set[str],
         fix_perms: bool = False,
         verbose: bool = False,
+        cache_dir: Optional[str] = None,
+        skip_size: bool = False,
     ) -> List[DirResult]:
+    """Checks all corpora in base_dir. Corpora are independent, so they're
+    checked in parallel (one process per core, but no more than there are
+    corpora); results are in the same order as get_dirs()."""
     paths = get_dirs(base_dir)
-    return [
-        check_dir(p, std_grps, restricted_grps, ok_owners, fix_perms, verbose)
-        for p in paths
-    ]
+    check_one = functools.partial(
+        check_dir,
+        std_grps=std_grps,
+        restricted_grps=restricted_grps,
+        ok_owners=ok_owners,
+        fix_perms=fix_perms,
+        verbose=verbose,
+        cache_dir=cache_dir,
+        skip_size=skip_size,
+    )
+    n_workers = max(1, min(len(paths), os.cpu_count() or 1))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as ex:
+        return list(ex.map(check_one, paths))
 
 
 def main() -> None:
@@ -681,32 +1127,51 @@ def main() -> None:
         '--plot-dest',
         type=str,
         help='if provided, writes a donut plot of corpora disk space usage to this location.')
+    parser.add_argument(
+        '--plot-backend',
+        choices=['svg', 'matplotlib'],
+        help='how to draw the plot. svg writes an SVG (so --plot-dest must end in .svg) and needs no extra dependencies; matplotlib picks the format from --plot-dest\'s extension (e.g., .png). If not provided, uses svg for .svg destinations and matplotlib otherwise.')
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        help='if provided, caches per-corpus results here, and reuses them for corpora whose directory and README.md are unchanged (including their perms) since the last run. Faster, but misses changes deeper inside corpora (e.g., permissions of files in original/). Not read from with --fix-perms.')
+    parser.add_argument(
+        '--skip-size',
+        action='store_true',
+        help='whether to skip computing corpora sizes (shown as "-"). Faster, as parts of corpora that aren\'t checked (e.g., stray directories) aren\'t walked. Can\'t be used with --plot-dest.')
     args = parser.parse_args()
+    if args.skip_size and args.plot_dest is not None:
+        parser.error('--plot-dest needs sizes, so can\'t be used with --skip-size')
+    if args.plot_dest is not None:
+        plot_is_svg = args.plot_dest.lower().endswith('.svg')
+        if args.plot_backend is None:
+            args.plot_backend = 'svg' if plot_is_svg else 'matplotlib'
+        elif args.plot_backend == 'svg' and not plot_is_svg:
+            parser.error('--plot-backend svg only writes SVGs, so --plot-dest must end in .svg')
+        # fail now rather than after the readme is written but before the log
+        # is (which would lose the failure email).
+        if args.plot_backend == 'matplotlib':
+            try:
+                import matplotlib
+            except ImportError:
+                parser.error('plotting to "{}" needs matplotlib (pip install matplotlib), or use a .svg --plot-dest'.format(args.plot_dest))
 
     # extract
     std_grps, restricted_grps = extract_group_config(args.group_config)
     ok_owners = set(args.ok_owners.split(','))
 
     # run
-    results = check(args.directory, std_grps, restricted_grps, ok_owners, args.fix_perms, args.verbose)
+    cache_dir = os.path.expanduser(args.cache_dir) if args.cache_dir is not None else None
+    results = check(args.directory, std_grps, restricted_grps, ok_owners, args.fix_perms, args.verbose, cache_dir, args.skip_size)
     success = compute_success(results)
 
-    # build out md file
-    out = '\n'.join([
-        build_top(success),
-        read(HEADER_FN),
-        generate_results_markdown(results, std_grps),
-        read(MID_FN),
-        generate_access_markdown(restricted_grps),
-        read(FOOTER_FN),
-    ])
-
-    # write output
+    # write output md file
     if args.out_file is not None:
         with open(os.path.expanduser(args.out_file), 'w') as f:
-            f.write(out)
+            write_readme(f, success, results, std_grps, restricted_grps)
     else:
-        print(out)
+        write_readme(sys.stdout, success, results, std_grps, restricted_grps)
+        print()
 
     # maybe write doc dir
     if args.doc_dir is not None:
@@ -714,17 +1179,23 @@ def main() -> None:
 
     # maybe write plot
     if args.plot_dest is not None:
-        plot(results, os.path.expanduser(args.plot_dest))
+        if args.plot_backend == 'matplotlib':
+            plot_matplotlib(results, os.path.expanduser(args.plot_dest))
+        else:
+            plot_svg(results, os.path.expanduser(args.plot_dest))
 
     # write log. always write to log file, if provided. write to stderr only if
-    # the overall results was not 100% successful.
-    log = generate_log(args.directory, success, results)
-    if args.log_file is not None:
-        with open(os.path.expanduser(args.log_file), 'w') as f:
-            f.write(log)
-    if not success:
-        print(log, file=sys.stderr)
-
+    # the overall results was not 100% successful. lines are written out as
+    # they're generated.
+    with contextlib.ExitStack() as stack:
+        log_dests: List[IO[str]] = []
+        if args.log_file is not None:
+            log_dests.append(stack.enter_context(open(os.path.expanduser(args.log_file), 'w')))
+        if not success:
+            log_dests.append(sys.stderr)
+        for line in generate_log(args.directory, success, results):
+            for dest in log_dests:
+                dest.write(line + '\n')
 
 if __name__ == '__main__':
     main()